@@ -1,22 +1,76 @@
+import base64
+import logging
 import os
+import re
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List, Optional, Set
 
 import daft
+import orjson
 import pandas as pd
 from flask import (
     Flask,
+    abort,
     jsonify,
     render_template,
     request,
     send_file,
-    send_from_directory,
 )
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.security import safe_join
 
 from pipeline import process_dataframe_pipeline
-from timelapse import create_timelapse_video, get_batch_media_info
+from timelapse import (
+    create_timelapse_video,
+    get_batch_images,
+    get_batch_media_info,
+    mtime_is_settled,
+    preload_year_overlays,
+)
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, so jsonify serializes in C (including numpy scalars)"""
+    
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of round-tripping through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.option),
+            mimetype=self.mimetype
+        )
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+logger = logging.getLogger(__name__)
+
+# Years generated for every batch
+YEARS = [1850, 1950, 2000, 2020, 2050]
+
+# Every batch uses the same years, so render their timelapse labels once at startup
+preload_year_overlays(YEARS)
+
+# Pipeline runs mostly wait on the Mapbox and Gemini APIs, so a small thread
+# pool keeps them off the request threads
+PIPELINE_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Job state shared across worker processes lives in output/<batch_id>/status.json;
+# a job still 'processing' this long after it started running (not after it
+# was queued) is reported as failed
+BATCH_STATUS_FILENAME = 'status.json'
+PIPELINE_TIMEOUT_SECONDS = 30 * 60
 
 # Configuration
 # Mapbox Access Token - Used for the interactive map feature
@@ -29,33 +83,138 @@ app = Flask(__name__)
 # The token below is a default for development only
 MAPBOX_TOKEN = os.environ.get('MAPBOX_ACCESS_TOKEN', 'pk.eyJ1IjoiY3Jpc3N0bzM5IiwiYSI6ImNtZjNveHE0dzAwOWwybHF6OTNxeHJpZHAifQ.oEhiJlxp2k2Jpx_JVU1ivA')
 
+# Internal Nginx location that maps to the output directory (e.g. '/internal/output/').
+# When set, output files are handed to Nginx via X-Accel-Redirect so it can
+# stream them with sendfile instead of Python reading them
+OUTPUT_ACCEL_REDIRECT = os.environ.get('OUTPUT_ACCEL_REDIRECT')
+
+# Generated image filenames: img_{lat}_{lon}_{alt}_{year}.png
+_NUMBER = r'-?\d+(?:\.\d+)?(?:e[-+]?\d+)?'
+_IMAGE_FILENAME_RE = re.compile(rf'img_({_NUMBER})_({_NUMBER})_({_NUMBER})_(\d+)\.png')
+
+# Output files already seen to exist. Only hits are cached: misses are checked
+# fresh so a file created by another worker process is found immediately
+_known_output_files: Set[str] = set()
+_KNOWN_OUTPUT_FILES_MAX = 4096
+
+def _is_output_file(path: str) -> bool:
+    """Existence check for generated files that caches positive results"""
+    if path in _known_output_files:
+        return True
+    if not Path(path).is_file():
+        return False
+    if len(_known_output_files) >= _KNOWN_OUTPUT_FILES_MAX:
+        _known_output_files.clear()
+    _known_output_files.add(path)
+    return True
+
+def _forget_output_file(path: str) -> None:
+    """Drop a cached hit for a file that has since disappeared"""
+    _known_output_files.discard(path)
+
+# Images never change once written; batch info must be revalidated while a batch is processing
+IMAGE_CACHE_CONTROL = 'public, max-age=86400'
+BATCH_INFO_CACHE_CONTROL = 'no-cache'
+
+def _stat_etag(stat: os.stat_result, variant: str = '') -> str:
+    """Build an ETag from mtime and size, optionally tagged with a response variant"""
+    etag = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+    return f'{etag}-{variant}' if variant else etag
+
+def _cached_response(response, etag: str, cache_control: str):
+    """Attach the ETag and Cache-Control headers to a response"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def _not_modified(etag: str, cache_control: str):
+    """Empty 304 reply for a client that already has the current version"""
+    return _cached_response(app.response_class(status=304), etag, cache_control)
+
 # Configure Flask to serve static files from output directory
 @app.route('/static/output/<path:filename>')
 def serve_output_files(filename):
     """Serve files from the output directory as static files"""
-    return send_from_directory('output', filename)
+    file_path = safe_join('output', filename)
+    if file_path is None or not _is_output_file(file_path):
+        abort(404)
+    
+    if OUTPUT_ACCEL_REDIRECT:
+        response = app.response_class()
+        response.headers['X-Accel-Redirect'] = OUTPUT_ACCEL_REDIRECT.rstrip('/') + '/' + filename
+        # Let Nginx pick the Content-Type from the file extension
+        del response.headers['Content-Type']
+        return response
+    
+    try:
+        return send_file(file_path, conditional=True, etag=True)
+    except FileNotFoundError:
+        _forget_output_file(file_path)
+        abort(404)
 
 @app.route('/')
 def index():
     """Serve the main UI page"""
     return render_template('index.html', mapbox_token=MAPBOX_TOKEN)
 
-@app.route('/process', methods=['POST'])
-def process_coordinates():
-    """Process the coordinates through the Daft pipeline for multiple years"""
+def _batch_status_path(batch_id: str) -> Path:
+    return Path('output') / batch_id / BATCH_STATUS_FILENAME
+
+def _write_batch_status(batch_id: str, status: dict) -> None:
+    """Atomically replace a batch's status file so every worker process sees the same state"""
+    status_path = _batch_status_path(batch_id)
+    tmp_path = status_path.with_name(f'{status_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    tmp_path.write_bytes(orjson.dumps(status, option=ORJSONProvider.option))
+    os.replace(tmp_path, status_path)
+
+def _read_batch_status(batch_id: str) -> Optional[dict]:
+    """Read a batch's status file, or None if it has none"""
+    try:
+        status_path = _batch_status_path(batch_id)
+        status = orjson.loads(status_path.read_bytes())
+    except FileNotFoundError:
+        return None
+    
+    # A job whose worker died (restart, recycle) never writes its result.
+    # Queued jobs have no started_at yet, so time spent waiting for a free
+    # executor thread doesn't count against them
+    started_at = status.get('started_at')
+    if status['status'] == 'processing' and started_at is not None and time.time() - started_at > PIPELINE_TIMEOUT_SECONDS:
+        return {
+            'success': False,
+            'batch_id': batch_id,
+            'status': 'failed',
+            'error': 'Processing did not finish in time; please try again'
+        }
+    return status
+
+def _run_pipeline(batch_id: str, latitude: float, longitude: float, altitude: float, years: List[int]) -> dict:
+    """Process a batch and record the outcome in its status file"""
+    try:
+        _write_batch_status(batch_id, {
+            'success': True,
+            'batch_id': batch_id,
+            'status': 'processing',
+            'started_at': time.time()
+        })
+    except OSError:
+        logger.exception(f"Could not write status for batch {batch_id}")
+    
+    result = _process_batch(batch_id, latitude, longitude, altitude, years)
+    status = {
+        **result,
+        'batch_id': batch_id,
+        'status': 'complete' if result['success'] else 'failed'
+    }
+    try:
+        _write_batch_status(batch_id, status)
+    except OSError:
+        logger.exception(f"Could not write status for batch {batch_id}")
+    return status
+
+def _process_batch(batch_id: str, latitude: float, longitude: float, altitude: float, years: List[int]) -> dict:
+    """Run the Daft pipeline for one batch and summarise which years succeeded"""
     try:
-        # Get data from the form
-        data = request.get_json()
-        latitude = float(data['latitude'])
-        longitude = float(data['longitude'])
-        altitude = float(data['altitude'])
-        
-        # Generate a unique batch ID for this request
-        batch_id = f"web_{uuid.uuid4().hex[:8]}"
-        
-        # Years to process
-        years = [1850, 1950, 2000, 2020, 2050]
-        
         # Create a DataFrame with multiple rows (one for each year)
         df_data = {
             'batchID': [batch_id] * len(years),
@@ -90,7 +249,7 @@ def process_coordinates():
                     failed_years.append(year)
             
             if successful_years:
-                return jsonify({
+                return {
                     'success': True,
                     'batch_id': batch_id,
                     'years': successful_years,
@@ -101,17 +260,52 @@ def process_coordinates():
                         'altitude': altitude
                     },
                     'message': f'Successfully processed {len(successful_years)} years for coordinates ({latitude}, {longitude}, {altitude})'
-                })
+                }
             else:
-                return jsonify({
+                return {
                     'success': False,
                     'error': 'Failed to create any files'
-                })
+                }
         else:
-            return jsonify({
+            return {
                 'success': False,
                 'error': 'No results returned from pipeline'
-            })
+            }
+            
+    except Exception as e:
+        logger.exception(f"Pipeline failed for batch {batch_id}")
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+@app.route('/process', methods=['POST'])
+def process_coordinates():
+    """Start processing the coordinates through the Daft pipeline for multiple years"""
+    try:
+        # Get data from the form
+        data = request.get_json()
+        latitude = float(data['latitude'])
+        longitude = float(data['longitude'])
+        altitude = float(data['altitude'])
+        
+        # Generate a unique batch ID for this request
+        batch_id = f"web_{uuid.uuid4().hex[:8]}"
+        
+        # Record the job up front so a status check on any worker can find it
+        (Path('output') / batch_id).mkdir(parents=True, exist_ok=True)
+        _write_batch_status(batch_id, {'success': True, 'batch_id': batch_id, 'status': 'processing'})
+        
+        # Run the pipeline in the background and let the client poll for the result
+        PIPELINE_EXECUTOR.submit(_run_pipeline, batch_id, latitude, longitude, altitude, YEARS)
+        
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'status': 'processing',
+            'status_url': f'/api/status/{batch_id}',
+            'message': f'Started processing {len(YEARS)} years for coordinates ({latitude}, {longitude}, {altitude})'
+        })
             
     except Exception as e:
         return jsonify({
@@ -119,6 +313,35 @@ def process_coordinates():
             'error': str(e)
         })
 
+@app.route('/api/status/<batch_id>')
+def get_process_status(batch_id):
+    """Get the processing status of a batch started with /process"""
+    try:
+        status = _read_batch_status(batch_id)
+        if status is not None:
+            return jsonify(status)
+        
+        # Batches created without a status file (e.g. by pipeline.py)
+        try:
+            batch_images = get_batch_images(batch_id)
+        except FileNotFoundError:
+            return jsonify({'error': 'Batch not found'}), 404
+        if not batch_images:
+            return jsonify({'error': 'Batch status not found'}), 404
+        
+        years = sorted(batch_images)
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'status': 'complete',
+            'years': years,
+            'failed_years': [],
+            'message': f'Successfully processed {len(years)} years'
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/results/<batch_id>')
 def results_page(batch_id):
     """Serve the results page with year slider"""
@@ -133,42 +356,66 @@ def get_image_content(batch_id, year):
         if not batch_dir.exists():
             return jsonify({'error': 'Batch not found'}), 404
         
-        # Look for files matching the pattern
-        image_files = list(batch_dir.glob(f'*_{year}.png'))
-        if not image_files:
+        # Look up the image for this year
+        image_path = get_batch_images(batch_id).get(year)
+        if image_path is None:
             return jsonify({'error': f'No image found for year {year}'}), 404
         
-        image_path = image_files[0]
+        # Generated files are written once, so a matching ETag skips the read entirely
+        include_content = request.args.get('include_content', 'true').lower() == 'true'
+        etag = _stat_etag(image_path.stat(), variant='' if include_content else 'meta')
+        if etag in request.if_none_match:
+            return _not_modified(etag, IMAGE_CACHE_CONTROL)
         
         # Check if it's an image file or text file
         if image_path.suffix.lower() in ['.png', '.jpg', '.jpeg']:
-            # For image files, encode as base64 for web display
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-            import base64
-            content_base64 = base64.b64encode(image_data).decode('utf-8')
-            
-            return jsonify({
+            response = {
                 'success': True,
                 'year': year,
                 'filename': image_path.name,
                 'content_type': 'image',
-                'content': content_base64,
+                'raw_url': f'/api/get_image_raw/{batch_id}/{year}',
                 'path': str(image_path)
-            })
+            }
+            
+            # The web UI fetches the raw bytes from raw_url instead, so the
+            # base64 payload is only built for API clients that still want it
+            if include_content:
+                with open(image_path, 'rb') as f:
+                    image_data = f.read()
+                response['content'] = base64.b64encode(image_data).decode('utf-8')
+            
+            return _cached_response(jsonify(response), etag, IMAGE_CACHE_CONTROL)
         else:
             # For text files, read as text
             with open(image_path, 'r') as f:
                 content = f.read()
             
-            return jsonify({
+            return _cached_response(jsonify({
                 'success': True,
                 'year': year,
                 'filename': image_path.name,
                 'content_type': 'text',
                 'content': content,
                 'path': str(image_path)
-            })
+            }), etag, IMAGE_CACHE_CONTROL)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/get_image_raw/<batch_id>/<int:year>')
+def get_image_raw(batch_id, year):
+    """Serve the raw image bytes for a specific year"""
+    try:
+        batch_dir = Path('output') / batch_id
+        if not batch_dir.exists():
+            return jsonify({'error': 'Batch not found'}), 404
+        
+        image_path = get_batch_images(batch_id).get(year)
+        if image_path is None:
+            return jsonify({'error': f'No image found for year {year}'}), 404
+        
+        return send_file(image_path, mimetype='image/png', conditional=True, etag=True)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -181,40 +428,41 @@ def get_batch_info(batch_id):
         if not batch_dir.exists():
             return jsonify({'error': 'Batch not found'}), 404
         
-        # Find all image files and extract years
-        image_files = list(batch_dir.glob('*.png'))
-        available_years = []
-        coordinates = {}
+        # The directory mtime changes whenever a file is added, like the scan cache,
+        # but only once it has settled can a later write be relied on to change it
+        batch_stat = batch_dir.stat()
+        etag = _stat_etag(batch_stat) if mtime_is_settled(batch_stat.st_mtime_ns) else None
+        if etag is not None and etag in request.if_none_match:
+            return _not_modified(etag, BATCH_INFO_CACHE_CONTROL)
         
-        for image_file in image_files:
-            # Parse filename to extract year and coordinates
-            # Format: img_lat_lon_alt_year.png
-            parts = image_file.stem.split('_')
-            if len(parts) >= 5:
-                try:
-                    year = int(parts[-1])
-                    lat = float(parts[1])
-                    lon = float(parts[2])
-                    alt = float(parts[3])
-                    
-                    available_years.append(year)
-                    if not coordinates:  # Use first file to get coordinates
-                        coordinates = {
-                            'latitude': lat,
-                            'longitude': lon,
-                            'altitude': alt
-                        }
-                except (ValueError, IndexError):
-                    continue
+        # Years were already parsed from the filenames by the batch scan
+        batch_images = get_batch_images(batch_id)
+        available_years = sorted(batch_images)
         
-        available_years.sort()
+        # Use the first file that parses to get coordinates
+        # Format: img_lat_lon_alt_year.png
+        coordinates = {}
+        for image_file in batch_images.values():
+            match = _IMAGE_FILENAME_RE.fullmatch(image_file.name)
+            if match:
+                lat, lon, alt, _ = match.groups()
+                coordinates = {
+                    'latitude': float(lat),
+                    'longitude': float(lon),
+                    'altitude': float(alt)
+                }
+                break
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'batch_id': batch_id,
             'available_years': available_years,
             'coordinates': coordinates
         })
+        if etag is None:
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        return _cached_response(response, etag, BATCH_INFO_CACHE_CONTROL)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -224,7 +472,7 @@ def download_file(filename):
     """Allow downloading of generated files"""
     try:
         file_path = Path('output') / filename
-        if file_path.exists():
+        if _is_output_file(str(file_path)):
             # Check if it's a request for inline viewing (for video preview)
             inline = request.args.get('inline', 'false').lower() == 'true'
             
@@ -241,10 +489,18 @@ def download_file(filename):
                 file_path, 
                 as_attachment=not inline,
                 mimetype=mimetype,
-                download_name=file_path.name if not inline else None
+                download_name=file_path.name if not inline else None,
+                # Honour Range and If-None-Match so videos can start playing
+                # and seek without downloading the whole file
+                conditional=True,
+                etag=True
             )
         else:
             return jsonify({'error': 'File not found'}), 404
+    except FileNotFoundError:
+        # Deleted after it was cached as existing
+        _forget_output_file(str(file_path))
+        return jsonify({'error': 'File not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -258,18 +514,24 @@ def list_outputs():
         if not output_dir.exists():
             return jsonify({'files': []})
         
+        # scandir entries carry the file type (and on Windows the stat data)
+        # from the directory listing, saving a syscall per check
         files = []
-        for batch_dir in output_dir.iterdir():
-            if batch_dir.is_dir():
-                for file_path in batch_dir.glob('*.png'):
-                    relative_path = file_path.relative_to(output_dir)
-                    files.append({
-                        'batch_id': batch_dir.name,
-                        'filename': file_path.name,
-                        'path': str(relative_path),
-                        'size': file_path.stat().st_size,
-                        'modified': file_path.stat().st_mtime
-                    })
+        with os.scandir(output_dir) as batch_dirs:
+            for batch_dir in batch_dirs:
+                if not batch_dir.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(batch_dir.path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith('.png') and entry.is_file():
+                            stat = entry.stat()
+                            files.append({
+                                'batch_id': batch_dir.name,
+                                'filename': entry.name,
+                                'path': os.path.join(batch_dir.name, entry.name),
+                                'size': stat.st_size,
+                                'modified': stat.st_mtime
+                            })
         
         return jsonify({'files': files})
     except Exception as e:
@@ -326,6 +588,7 @@ if __name__ == '__main__':
     # Ensure templates directory exists
     Path('templates').mkdir(exist_ok=True)
     
+    # Development server only - use gunicorn in production (see README)
     print("Starting Flask web server...")
-    print("Open your browser to: http://localhost:5000")
+    print("Open your browser to: http://localhost:5001")
     app.run(debug=True, host='0.0.0.0', port=5001)
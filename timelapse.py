@@ -1,12 +1,82 @@
 import cv2
 import numpy as np
 from pathlib import Path
+import itertools
 import logging
 import os
-from typing import List
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Codecs to try in order: H.264 plays in every browser, mp4v is the fallback
+# for OpenCV builds whose FFmpeg lacks an H.264 encoder
+VIDEO_CODECS = ('avc1', 'mp4v')
+
+# H.264 encoders to try when piping into ffmpeg, as (name, global options,
+# extra video filters, output options); libx264 is the software fallback
+FFMPEG_H264_ENCODERS = (
+    ('h264_nvenc', (), (), ('-c:v', 'h264_nvenc', '-pix_fmt', 'yuv420p')),
+    ('h264_vaapi', ('-vaapi_device', '/dev/dri/renderD128'), ('format=nv12', 'hwupload'), ('-c:v', 'h264_vaapi')),
+    ('libx264', (), (), ('-c:v', 'libx264', '-pix_fmt', 'yuv420p')),
+)
+
+# Directory mtimes come from the coarse kernel clock, so writes a few
+# milliseconds apart can share one; only trust mtimes older than this
+MTIME_SETTLE_NS = 1_000_000_000
+
+def mtime_is_settled(mtime_ns: int) -> bool:
+    """Whether an mtime is old enough that a later write is guaranteed to change it"""
+    return time.time_ns() - mtime_ns >= MTIME_SETTLE_NS
+
+@lru_cache(maxsize=256)
+def _scan_batch_images(batch_dir: str, mtime_ns: int) -> Dict[int, Path]:
+    """Map year -> image path with a single scandir pass over a batch directory.
+    
+    mtime_ns is only part of the cache key, so a new file landing in the
+    directory forces a rescan on the next lookup (see get_batch_images for
+    why recently modified directories bypass the cache).
+    """
+    images = {}
+    with os.scandir(batch_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            # Format: img_lat_lon_alt_year.png
+            if not name.startswith('img_') or not name.endswith('.png'):
+                continue
+            # The year is always the suffix after the last '_'
+            sep = name.rfind('_')
+            if sep < 0:
+                continue
+            try:
+                year = int(name[sep + 1:-4])
+            except ValueError:
+                continue
+            images[year] = Path(entry.path)
+    return images
+
+def get_batch_images(batch_id: str) -> Dict[int, Path]:
+    """
+    Get the images of a batch keyed by year.
+    
+    The result is cached per directory mtime and shared between callers,
+    so it must not be modified.
+    
+    Raises:
+        FileNotFoundError: If the batch directory does not exist
+    """
+    batch_dir = os.path.join('output', batch_id)
+    mtime_ns = os.stat(batch_dir).st_mtime_ns
+    if not mtime_is_settled(mtime_ns):
+        # Another file may still land within the same mtime tick without
+        # changing the key, so don't cache a scan of a directory in flux
+        return _scan_batch_images.__wrapped__(batch_dir, mtime_ns)
+    return _scan_batch_images(batch_dir, mtime_ns)
+
 def create_timelapse_video(batch_id: str, output_format: str = 'mp4') -> str:
     """
     Create an MP4 timelapse video from images in a batch directory.
@@ -26,21 +96,12 @@ def create_timelapse_video(batch_id: str, output_format: str = 'mp4') -> str:
         raise FileNotFoundError(f"Batch directory not found: {batch_dir}")
     
     # Find all image files and sort by year
-    image_files = list(batch_dir.glob('*.png'))
-    if not image_files:
+    batch_images = get_batch_images(batch_id)
+    if not batch_images:
         raise FileNotFoundError(f"No images found in batch directory: {batch_dir}")
     
-    # Extract year from filename and sort
-    def extract_year(filepath):
-        try:
-            # Format: img_lat_lon_alt_year.png
-            parts = filepath.stem.split('_')
-            return int(parts[-1])
-        except (ValueError, IndexError):
-            return 0
-    
-    image_files.sort(key=extract_year)
-    years = [extract_year(f) for f in image_files]
+    years = sorted(batch_images)
+    image_files = [batch_images[year] for year in years]
     
     logger.info(f"Creating MP4 timelapse for years: {years}")
     
@@ -50,73 +111,242 @@ def create_timelapse_video(batch_id: str, output_format: str = 'mp4') -> str:
     
     return create_mp4_timelapse(image_files, years, output_path)
 
-def create_mp4_timelapse(image_files: List[Path], years: List[int], output_path: Path, fps: int = 1) -> str:
-    """Create MP4 timelapse video"""
+def read_image(image_file: Path) -> Optional[np.ndarray]:
+    """Read and decode an image from an in-memory buffer, returning None like cv2.imread on failure"""
+    try:
+        with open(image_file, 'rb') as f:
+            buf = f.read()
+    except OSError:
+        return None
+    if not buf:
+        return None
+    return cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
+
+def open_video_writer(output_path: Path, fps: float, frame_size: Tuple[int, int]) -> cv2.VideoWriter:
+    """Open an OpenCV MP4 writer (used when ffmpeg is unavailable), preferring hardware-accelerated H.264"""
+    hw_params = [cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+    for codec in VIDEO_CODECS:
+        fourcc = cv2.VideoWriter_fourcc(*codec)
+        for params in (hw_params, []):
+            video_writer = cv2.VideoWriter(str(output_path), cv2.CAP_FFMPEG, fourcc, fps, frame_size, params)
+            if video_writer.isOpened():
+                logger.info(f"Encoding {output_path} with {codec} (hardware acceleration requested: {bool(params)})")
+                return video_writer
+            video_writer.release()
     
-    # Read first image to get dimensions
-    first_image = cv2.imread(str(image_files[0]))
-    if first_image is None:
-        raise ValueError(f"Could not read image: {image_files[0]}")
+    raise ValueError(f"Could not open a video writer for {output_path} with any of {VIDEO_CODECS}")
+
+def find_ffmpeg() -> Optional[str]:
+    """Locate an ffmpeg binary, preferring the one bundled with imageio-ffmpeg"""
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        return shutil.which('ffmpeg')
+
+@lru_cache(maxsize=None)
+def _ffmpeg_h264_encoder(ffmpeg: str) -> Tuple[str, Tuple[str, ...], Tuple[str, ...], Tuple[str, ...]]:
+    """Pick the first H.264 encoder that can encode a test frame with this ffmpeg (cached per binary)"""
+    for encoder in FFMPEG_H264_ENCODERS[:-1]:
+        name, input_options, filters, output_options = encoder
+        command = [
+            ffmpeg, '-loglevel', 'error', *input_options,
+            '-f', 'lavfi', '-i', 'color=c=black:s=256x256:r=1', '-frames:v', '1',
+            *(['-vf', ','.join(filters)] if filters else []),
+            *output_options, '-f', 'null', '-'
+        ]
+        try:
+            probe = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            continue
+        if probe.returncode == 0:
+            logger.info(f"Using hardware H.264 encoder {name}")
+            return encoder
+    return FFMPEG_H264_ENCODERS[-1]
+
+def _run_ffmpeg_encoder(ffmpeg: str, encoder: Tuple, frames: Iterable[np.ndarray], output_path: Path, fps: float, frame_size: Tuple[int, int]) -> Tuple[int, bytes]:
+    """Pipe raw BGR frames into one ffmpeg encode and return its exit code and stderr"""
+    width, height = frame_size
+    _, input_options, filters, output_options = encoder
+    command = [
+        ffmpeg, '-y', '-loglevel', 'error', *input_options,
+        '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+        # yuv420p needs even dimensions
+        '-vf', ','.join(['pad=ceil(iw/2)*2:ceil(ih/2)*2', *filters]),
+        *output_options, '-movflags', '+faststart',
+        str(output_path)
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        for frame in frames:
+            try:
+                process.stdin.write(np.ascontiguousarray(frame).data)
+            except BrokenPipeError:
+                # ffmpeg exited early; its stderr explains why
+                break
+    except BaseException:
+        # Closing stdin would let ffmpeg finalise a truncated video, so kill it instead
+        process.kill()
+        process.communicate()
+        Path(output_path).unlink(missing_ok=True)
+        raise
     
-    height, width, channels = first_image.shape
+    _, stderr = process.communicate()
+    return process.returncode, stderr
+
+def write_ffmpeg_video(ffmpeg: str, frames: Iterable[np.ndarray], output_path: Path, fps: float, frame_size: Tuple[int, int]) -> None:
+    """
+    Pipe raw BGR frames into an ffmpeg H.264 encoder (hardware if available) running in its own process.
     
-    # Create video writer
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video_writer = cv2.VideoWriter(str(output_path), fourcc, fps, (width, height))
+    A hardware encode can still fail after the probe passed (NVENC session
+    limits, unsupported frame sizes, a busy VAAPI device), so frames sent to
+    it are kept and the video is re-encoded once with libx264 if it fails.
+    """
+    encoder = _ffmpeg_h264_encoder(ffmpeg)
+    software_encoder = FFMPEG_H264_ENCODERS[-1]
     
-    try:
-        for i, (image_file, year) in enumerate(zip(image_files, years)):
-            # Read image
-            img = cv2.imread(str(image_file))
-            if img is None:
-                logger.warning(f"Could not read image: {image_file}")
-                continue
-            
-            # Resize if needed
-            if img.shape[:2] != (height, width):
-                img = cv2.resize(img, (width, height))
-            
-            # Add year overlay
-            img_with_year = add_year_overlay(img, year, use_cv2=True)
-            
-            # Write frame multiple times for longer display (2 seconds per image at 1 fps)
-            frame_duration = 2 if fps == 1 else max(1, fps // 2)
-            for _ in range(frame_duration):
-                video_writer.write(img_with_year)
+    if encoder is not software_encoder:
+        # The frame generator reuses its buffer, so keep copies for the retry
+        frames = iter(frames)
+        sent = []
+        
+        def keep_sent(frames):
+            for frame in frames:
+                sent.append(frame.copy())
+                yield frame
+        
+        returncode, stderr = _run_ffmpeg_encoder(ffmpeg, encoder, keep_sent(frames), output_path, fps, frame_size)
+        if returncode == 0:
+            return
+        
+        logger.warning(
+            f"{encoder[0]} failed to encode {output_path}, retrying with {software_encoder[0]}: "
+            f"{stderr.decode(errors='replace').strip()}"
+        )
+        # Frames ffmpeg never read are still waiting in the original iterator
+        frames = itertools.chain(sent, frames)
+    
+    returncode, stderr = _run_ffmpeg_encoder(ffmpeg, software_encoder, frames, output_path, fps, frame_size)
+    if returncode != 0:
+        Path(output_path).unlink(missing_ok=True)
+        raise ValueError(f"ffmpeg failed to encode {output_path}: {stderr.decode(errors='replace').strip()}")
+
+def _timelapse_frames(image_files: List[Path], images: Iterable[Optional[np.ndarray]], years: List[int], frame_size: Tuple[int, int]) -> Iterator[np.ndarray]:
+    """
+    Resize decoded images to the video size and add the year overlay, skipping unreadable ones.
+    
+    Resized frames share one reusable buffer, so each yielded frame is only
+    valid until the next one is requested.
+    """
+    width, height = frame_size
+    frame = np.empty((height, width, 3), np.uint8)
+    for image_file, img, year in zip(image_files, images, years):
+        if img is None:
+            logger.warning(f"Could not read image: {image_file}")
+            continue
+        
+        # Resize if needed, straight into the shared buffer
+        if img.shape[:2] != (height, width):
+            resized = cv2.resize(img, frame_size, dst=frame)
+            if resized is not frame:
+                # Some OpenCV builds ignore dst and allocate a new array
+                np.copyto(frame, resized)
+            img = frame
         
-    finally:
-        video_writer.release()
+        # Add year overlay
+        add_year_overlay(img, year, use_cv2=True)
+        yield img
+
+def create_mp4_timelapse(image_files: List[Path], years: List[int], output_path: Path, fps: float = 0.5) -> str:
+    """Create MP4 timelapse video (one frame per image, shown for 1/fps seconds)"""
+    
+    # Decode in a thread pool (file reads and libpng both release the GIL)
+    # while earlier frames are already being overlaid and encoded
+    max_workers = min(len(image_files), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        images = executor.map(read_image, image_files)
+        
+        # First image sets the video dimensions
+        first_image = next(images)
+        if first_image is None:
+            raise ValueError(f"Could not read image: {image_files[0]}")
+        
+        height, width, channels = first_image.shape
+        frames = _timelapse_frames(image_files, itertools.chain([first_image], images), years, (width, height))
+        
+        ffmpeg = find_ffmpeg()
+        if ffmpeg:
+            write_ffmpeg_video(ffmpeg, frames, output_path, fps, (width, height))
+        else:
+            # Create video writer
+            video_writer = open_video_writer(output_path, fps, (width, height))
+            
+            try:
+                for frame in frames:
+                    video_writer.write(frame)
+                
+            except BaseException:
+                video_writer.release()
+                Path(output_path).unlink(missing_ok=True)
+                raise
+            else:
+                video_writer.release()
     
     logger.info(f"Created MP4 timelapse: {output_path}")
     return str(output_path)
 
 # Removed GIF and WebM functions - only MP4 supported now
 
-def add_year_overlay(img: np.ndarray, year: int, use_cv2: bool = True) -> np.ndarray:
-    """Add year overlay to image using OpenCV"""
+@lru_cache(maxsize=64)
+def _year_text_sprite(year: int) -> Tuple[int, int, np.ndarray]:
+    """
+    Render the year label once and cache it as an alpha mask.
+    
+    Returns:
+        (top, left, alpha): image position of the label's bounding box and its
+        per-pixel coverage in [0, 1], shaped (h, w, 1) for broadcasting over BGR
+    """
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 2.0
+    thickness = 3
+    
+    text = str(year)
+    text_x = 20
+    text_y = 50
+    
+    (text_width, _), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+    canvas = np.zeros((text_y + baseline + thickness, text_x + text_width + thickness), np.uint8)
+    cv2.putText(canvas, text, (text_x, text_y), font, font_scale, 255, thickness)
+    
+    rows = np.flatnonzero(canvas.any(axis=1))
+    cols = np.flatnonzero(canvas.any(axis=0))
+    top, left = int(rows[0]), int(cols[0])
+    alpha = canvas[top:rows[-1] + 1, left:cols[-1] + 1, np.newaxis] / np.float32(255)
+    alpha.flags.writeable = False
+    return top, left, alpha
+
+def preload_year_overlays(years: Iterable[int]) -> None:
+    """Render the year label sprites ahead of time so video builds only blend them"""
+    for year in years:
+        _year_text_sprite(year)
+
+def add_year_overlay(img: np.ndarray, year: int, use_cv2: bool = True, inplace: bool = True) -> np.ndarray:
+    """Add year overlay to image using OpenCV (modifies img unless inplace=False)"""
     if use_cv2:
-        # Create a copy to avoid modifying original
-        img_copy = img.copy()
-        
-        # Add semi-transparent background for text
-        overlay = img_copy.copy()
-        cv2.rectangle(overlay, (10, 10), (200, 80), (0, 0, 0), -1)
-        cv2.addWeighted(overlay, 0.7, img_copy, 0.3, 0, img_copy)
+        if not inplace:
+            img = img.copy()
         
-        # Add year text
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = 2.0
-        color = (255, 255, 255)  # White
-        thickness = 3
+        # Darken only the text box region instead of blending a full-frame copy
+        roi = img[10:81, 10:201]
+        cv2.addWeighted(roi, 0.3, np.zeros_like(roi), 0.7, 0, dst=roi)
         
-        text = str(year)
-        text_size = cv2.getTextSize(text, font, font_scale, thickness)[0]
-        text_x = 20
-        text_y = 50
+        # Add year text by blending the cached sprite instead of re-rendering it
+        top, left, alpha = _year_text_sprite(year)
+        region = img[top:top + alpha.shape[0], left:left + alpha.shape[1]]
+        alpha = alpha[:region.shape[0], :region.shape[1]]
+        region[:] = region + (255 - region) * alpha + 0.5  # White
         
-        cv2.putText(img_copy, text, (text_x, text_y), font, font_scale, color, thickness)
-        
-        return img_copy
+        return img
     else:
         return img
 
@@ -138,14 +368,12 @@ def get_batch_media_info(batch_id: str) -> dict:
         return info
     
     # Find images
-    image_files = list(batch_dir.glob('*.png'))
-    for img_file in image_files:
-        if not img_file.name.startswith('timelapse_'):
-            info['images'].append({
-                'filename': img_file.name,
-                'path': str(img_file.relative_to(Path('output'))),
-                'size': img_file.stat().st_size
-            })
+    for img_file in get_batch_images(batch_id).values():
+        info['images'].append({
+            'filename': img_file.name,
+            'path': str(img_file.relative_to(Path('output'))),
+            'size': img_file.stat().st_size
+        })
     
     # Find MP4 videos only
     mp4_files = list(batch_dir.glob('*.mp4'))